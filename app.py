@@ -1,21 +1,46 @@
 import gradio as gr
 import google.genai as genai
 from google.genai import types
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 from typing import List
 import re
-import json
+import orjson
 import asyncio
+import diskcache
+import functools
+import itertools
 import os
-from serpapi import GoogleSearch
+import time
+import httpx
+import numpy as np
+from sentence_transformers import SentenceTransformer
 
 
-SERPAPI_KEY = "ENTER YOUR API KEY HERE"
+SERPAPI_KEY = os.environ.get("SERPAPI_KEY", "")
+
+# Shared Gemini client so the underlying transport is reused across calls
+_GENAI = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
+
+# Shared SerpAPI client so searches reuse pooled keep-alive connections
+_HTTPX = httpx.AsyncClient(
+    base_url="https://serpapi.com",
+    timeout=30.0,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    http2=True
+)
+
+# On-disk cache of SerpAPI results so repeated queries skip the network
+_SCACHE = diskcache.Cache(".serp_cache", size_limit=2**30)
 
 # ------------------------
 # Configuration
 # ------------------------
 NUM_SEARCHES = 3
+SEMANTIC_CACHE_THRESHOLD = 0.92  # Minimum cosine similarity for a cache hit
+SEMANTIC_CACHE_MAX_ENTRIES = 1024  # Oldest entries are overwritten beyond this
+SEMANTIC_CACHE_TTL = 24 * 60 * 60  # Seconds before a cached plan/report goes stale
+SEARCH_CACHE_TTL = 24 * 60 * 60  # Seconds to keep cached SerpAPI results
+MAX_PROMPT_URL_LENGTH = 120  # Longer URLs are truncated in the writer prompt
 
 # ------------------------
 # Pydantic Models
@@ -35,27 +60,109 @@ class ReportData(BaseModel):
 # ------------------------
 # Tool Functions
 # ------------------------
+_JSON_ESCAPES = str.maketrans({"\\": "\\\\", '"': '\\"', "\n": "\\n", "\r": "\\r"})
+
 def json_safe(text: str) -> str:
     """Escape characters that break JSON parsing."""
-    if not text:
-        return ""
-    return text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n").replace("\r", "\\r")
+    return text.translate(_JSON_ESCAPES) if text else ""
+def shorten_url(url: str) -> str:
+    """Truncate a URL to MAX_PROMPT_URL_LENGTH characters for prompting."""
+    if len(url) <= MAX_PROMPT_URL_LENGTH:
+        return url
+    return url[:MAX_PROMPT_URL_LENGTH - 1] + "…"
+
+def _find_json_object(text: str):
+    """
+    Returns the first balanced {...} block in text, or None.
+    Single linear scan that tracks brace depth and skips braces inside strings.
+    """
+    start = text.find("{")
+    if start == -1:
+        return None
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
+class _PartialJsonString:
+    """
+    Incrementally decodes one string field of a JSON document as it streams
+    in. Each update only scans and decodes the newly arrived text, and the
+    last successfully decoded value is kept if an escape is split mid-chunk.
+    """
+    def __init__(self, key: str):
+        self._pattern = re.compile(rf'"{key}"\s*:\s*"')
+        self._scanned = None  # offset of the next unscanned character of the value
+        self._decoded = 0     # offset up to which the raw value has been decoded
+        self._escaped = False
+        self._closed = False
+        self.value = ""
+
+    def update(self, text: str) -> str:
+        if self._scanned is None:
+            match = self._pattern.search(text)
+            if not match:
+                return self.value
+            self._scanned = self._decoded = match.end()
+        if self._closed:
+            return self.value
+
+        end = len(text)
+        for i in range(self._scanned, len(text)):
+            ch = text[i]
+            if self._escaped:
+                self._escaped = False
+            elif ch == "\\":
+                self._escaped = True
+            elif ch == '"':
+                end = i
+                self._closed = True
+                break
+        self._scanned = end
+
+        # Hold back an escape sequence that has not fully arrived; a
+        # surrogate pair (\uXXXX\uXXXX) can take up to 12 characters
+        raw = text[self._decoded:end]
+        for cut in range(min(len(raw), 12) + 1):
+            try:
+                self.value += orjson.loads(f'"{raw[:len(raw) - cut]}"')
+            except orjson.JSONDecodeError:
+                continue
+            self._decoded = end - cut
+            break
+        return self.value
+
 def extract_json(text: str):
     """
     Extracts the first JSON object from a text string.
     """
     try:
-        # Look for {...} block
-        match = re.search(r"\{.*\}", text, re.DOTALL)
-        if not match:
+        json_text = _find_json_object(text)
+        if json_text is None:
             raise ValueError("No JSON object found in text.")
-        json_text = match.group()
-        return json.loads(json_text)
-    except json.JSONDecodeError as e:
+        return orjson.loads(json_text)
+    except orjson.JSONDecodeError as e:
         raise ValueError(f"Failed to parse JSON: {str(e)}\nPreview: {text[:500]}")
 
 
-def search_web(query: str, reason: str) -> str:
+async def search_web(query: str, reason: str) -> dict:
     if not SERPAPI_KEY:
         raise ValueError("Missing SERPAPI_KEY environment variable")
 
@@ -66,15 +173,18 @@ def search_web(query: str, reason: str) -> str:
         "num": 5
     }
 
-    search = GoogleSearch(params)
-    data = search.get_dict()
+    cache_key = f"{query}|{params['num']}"
+    results = _SCACHE.get(cache_key)
+    if results is None:
+        response = await _HTTPX.get("/search.json", params=params)
+        response.raise_for_status()
+        data = orjson.loads(response.content)
 
-    results = []
-    for r in data.get("organic_results", []):
-        title = r.get("title", "No title")
-        url = r.get("link", "")
-        snippet = r.get("snippet", "")
-        results.append({"title": title, "url": url, "snippet": snippet})
+        results = [
+            {"title": r.get("title", "No title"), "url": r.get("link", ""), "snippet": r.get("snippet", "")}
+            for r in data.get("organic_results", [])
+        ]
+        _SCACHE.set(cache_key, results, expire=SEARCH_CACHE_TTL)
 
     search_output = {
         "query": query,
@@ -83,7 +193,59 @@ def search_web(query: str, reason: str) -> str:
         "summary": f"Top {len(results)} search results for '{query}'"
     }
 
-    return json.dumps(search_output)
+    return search_output
+
+# ------------------------
+# Semantic Cache
+# ------------------------
+# Loaded once at import so the first research request doesn't pay for it
+_EMBEDDER = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+if _EMBEDDER.device.type == "cuda":
+    _EMBEDDER.half()
+
+@functools.lru_cache(maxsize=256)
+def embed_query(query: str) -> np.ndarray:
+    """Returns a unit-length sentence embedding of a research query."""
+    return _EMBEDDER.encode([query.strip()], normalize_embeddings=True, convert_to_numpy=True)[0]
+
+class SemanticCache:
+    """
+    In-process cache that returns a stored value when a new query embedding
+    is close enough (cosine similarity) to a previously seen one.
+    Entries live in a fixed-size ring buffer and expire after ttl seconds.
+    """
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD,
+                 max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES, ttl: float = SEMANTIC_CACHE_TTL):
+        self.threshold = threshold
+        self.ttl = ttl
+        self._embeddings = None  # (max_entries, dim), allocated on first insert
+        self._values = [None] * max_entries
+        self._timestamps = np.full(max_entries, -np.inf)
+        self._next = 0
+
+    def get(self, embedding: np.ndarray):
+        if self._embeddings is None:
+            return None
+        similarities = self._embeddings @ embedding
+        # Empty and expired slots can never be a hit
+        similarities[self._timestamps < time.monotonic() - self.ttl] = -np.inf
+        best = int(np.argmax(similarities))
+        if similarities[best] >= self.threshold:
+            return self._values[best]
+        return None
+
+    def set(self, embedding: np.ndarray, value) -> None:
+        if self._embeddings is None:
+            self._embeddings = np.zeros((len(self._values), embedding.shape[0]), dtype=embedding.dtype)
+        slot = self._next
+        self._embeddings[slot] = embedding
+        self._values[slot] = value
+        self._timestamps[slot] = time.monotonic()
+        self._next = (slot + 1) % len(self._values)
+
+_PLAN_CACHE = SemanticCache()
+_REPORT_CACHE = SemanticCache()
+
 # ------------------------
 # System Instructions
 # ------------------------
@@ -118,46 +280,82 @@ Requirements:
 
 Return a JSON object with: {"short_summary": "...", "markdown_report": "...", "follow_up_questions": [...]}"""
 
+# Fixed prompt pieces and generation configs, built once rather than per request
+_PLANNER_HEAD = "Research Query: "
+_PLANNER_TAIL = "\n\nPlease provide the search plan in JSON format."
+_WRITER_TAIL = "\n\nPlease write a comprehensive report in JSON format with short_summary, markdown_report, and follow_up_questions."
+
+_PLANNER_CONFIG = types.GenerateContentConfig(
+    system_instruction=SEARCH_PLANNER_INSTRUCTION,
+    temperature=0.7,
+    response_mime_type="application/json",
+    response_schema=WebSearchPlan
+)
+_WRITER_CONFIG = types.GenerateContentConfig(
+    system_instruction=REPORT_WRITER_INSTRUCTION,
+    temperature=0.7,
+    response_mime_type="application/json",
+    response_schema=ReportData
+)
+
 # ------------------------
 # Helper Functions
 # ------------------------
 
 async def plan_searches(query: str, progress=gr.Progress()) -> WebSearchPlan:
     progress(0.1, desc="🧠 Planning research strategy...")
+
+    embedding = await asyncio.to_thread(embed_query, query)
+    cached_plan = _PLAN_CACHE.get(embedding)
+    if cached_plan is not None:
+        progress(0.2, desc=f"✓ Reused cached plan with {len(cached_plan.searches)} searches")
+        return cached_plan
     
-    client = genai.Client(api_key="ENTER YOUR API KEY HERE")
-    
-    input_text = f"{SEARCH_PLANNER_INSTRUCTION}\n\nResearch Query: {query}\n\nPlease provide the search plan in JSON format."
+    input_text = _PLANNER_HEAD + query + _PLANNER_TAIL
     
-    response = client.models.generate_content(
+    response = await _GENAI.aio.models.generate_content(
         model="gemini-2.0-flash-exp",
         contents=input_text,
-        config=types.GenerateContentConfig(
-            temperature=0.7,
-            response_mime_type="application/json"
-        )
+        config=_PLANNER_CONFIG
     )
     
-    # JSON-safe parsing
-    try:
-        data = extract_json(response.text)
-    except json.JSONDecodeError as e:
-        raise ValueError(f"Failed to parse JSON from Gemini response: {str(e)}\nResponse preview: {response.text[:500]}")
+    # Structured output; fall back to scraping the text if the SDK could not parse it
+    search_plan = response.parsed
+    if search_plan is None:
+        try:
+            data = extract_json(response.text)
+        except orjson.JSONDecodeError as e:
+            raise ValueError(f"Failed to parse JSON from Gemini response: {str(e)}\nResponse preview: {response.text[:500]}")
+        search_plan = WebSearchPlan(**data)
     
-    search_plan = WebSearchPlan(**data)
+    _PLAN_CACHE.set(embedding, search_plan)
     progress(0.2, desc=f"✓ Planned {len(search_plan.searches)} searches")
     return search_plan
 async def perform_searches(search_plan: WebSearchPlan, progress=gr.Progress()) -> List[dict]:
     """Execute web searches for each item in the search plan"""
-    results = []
-    total = len(search_plan.searches)
-    
-    for i, item in enumerate(search_plan.searches, 1):
-        progress(0.2 + (0.5 * i / total), desc=f"🔍 Searching ({i}/{total}): {item.query[:50]}...")
-        result_json = search_web(item.query, item.reason)
-        results.append(json.loads(result_json))
-        await asyncio.sleep(0.1)  # Small delay to show progress
-    
+    # Collapse queries that only differ by case/whitespace into one request
+    unique = {}
+    for item in search_plan.searches:
+        unique.setdefault(item.query.strip().lower(), item)
+
+    # Run all searches concurrently, reporting progress as each one finishes
+    total = len(unique)
+    tasks = {key: asyncio.create_task(search_web(item.query, item.reason)) for key, item in unique.items()}
+    try:
+        for done, future in enumerate(asyncio.as_completed(tasks.values()), 1):
+            result = await future
+            progress(0.2 + (0.5 * done / total), desc=f"✓ Searched ({done}/{total}): {result['query'][:50]}...")
+    finally:
+        for task in tasks.values():
+            task.cancel()
+    by_query = {key: task.result() for key, task in tasks.items()}
+
+    # Fan results back out to every planned search, keeping each one's reason
+    results = [
+        {**by_query[item.query.strip().lower()], "reason": item.reason}
+        for item in search_plan.searches
+    ]
+
     progress(0.7, desc="✓ Completed all searches")
     return results
 def build_references(search_results: list) -> str:
@@ -165,78 +363,109 @@ def build_references(search_results: list) -> str:
     Returns a clean Markdown references section with numbered items.
     Each reference includes title and URL.
     """
-    seen = set()
-    references_md = "## References\n\n"
-    counter = 1
-    
-    for search in search_results:
-        for res in search["results"]:
-            title = res.get("title", "No title")
-            url = res.get("url", "")
-            key = (title, url)
-            if key not in seen and url:
-                seen.add(key)
-                references_md += f"{counter}. [{title}]({url})\n"
-                counter += 1
-    
-    return references_md
+    # Ordered dedup by URL: url -> title of its first occurrence
+    seen = {}
+    for res in itertools.chain.from_iterable(search["results"] for search in search_results):
+        url = res.get("url", "")
+        if url and url not in seen:
+            seen[url] = res.get("title", "No title")
+
+    return "## References\n\n" + "".join(
+        f"{i}. [{title}]({url})\n" for i, (url, title) in enumerate(seen.items(), 1)
+    )
 
-async def write_report(query: str, search_results: List[dict], progress=gr.Progress()) -> ReportData:
+async def write_report(query: str, search_results: List[dict], progress=gr.Progress()):
+    """
+    Streams the report from Gemini. Yields (partial_markdown, None) while
+    tokens arrive, then (full_markdown, report) once the response is complete.
+    """
     progress(0.75, desc="📝 Writing comprehensive report...")
 
-    client = genai.Client(api_key="ENTER YOUR API KEY HERE")
-
-    # Build a JSON-safe summary of all search results
-    results_summary = "\n\n".join([
-        f"Search {i+1}: {json_safe(r['query'])}\nReason: {json_safe(r['reason'])}\nReferences:\n" +
-        "\n".join([f"{j+1}. {json_safe(res.get('url',''))}" for j, res in enumerate(r['results'])])
-        for i, r in enumerate(search_results)
-    ])
+    # Number each distinct URL once (same order as build_references) so
+    # searches sharing a source cite it by id instead of repeating the URL
+    ref_ids = {}
+    for r in search_results:
+        for res in r['results']:
+            url = res.get('url', '')
+            if url and url not in ref_ids:
+                ref_ids[url] = len(ref_ids) + 1
+
+    # Build a JSON-safe summary of all search results in a single buffer
+    buf = []
+    append = buf.append
+    append("References:")
+    for url, ref_id in ref_ids.items():
+        append(f"\n{ref_id}. ")
+        append(json_safe(shorten_url(url)))
+    for i, r in enumerate(search_results, 1):
+        append(f"\n\nSearch {i}: ")
+        append(json_safe(r['query']))
+        append("\nReason: ")
+        append(json_safe(r['reason']))
+        append("\nSources: ")
+        sources = dict.fromkeys(ref_ids[res['url']] for res in r['results'] if res.get('url'))
+        append(", ".join(f"[ref#{ref_id}]" for ref_id in sources))
+    results_summary = "".join(buf)
 
     input_text = (
-        f"{REPORT_WRITER_INSTRUCTION}\n\n"
         f"Original Research Query: {json_safe(query)}\n\n"
-        f"Search Results:\n{results_summary}\n\n"
-        "Please write a comprehensive report in JSON format with short_summary, markdown_report, and follow_up_questions."
+        f"Search Results:\n{results_summary}"
+        + _WRITER_TAIL
     )
 
-    response = client.models.generate_content(
+    response_text = ""
+    markdown_stream = _PartialJsonString("markdown_report")
+    async for chunk in await _GENAI.aio.models.generate_content_stream(
         model="gemini-2.0-flash-exp",
         contents=input_text,
-        config=types.GenerateContentConfig(
-            temperature=0.7,
-            response_mime_type="application/json"
-        )
-    )
-
-    # Robust JSON extraction
-    data = extract_json(response.text)
-    report = ReportData(**data)
+        config=_WRITER_CONFIG
+    ):
+        if chunk.text:
+            response_text += chunk.text
+            yield markdown_stream.update(response_text), None
+
+    # Parse once the stream is complete; response_schema makes the whole
+    # response a ReportData document, so scraping is only a fallback
+    try:
+        report = ReportData.model_validate_json(response_text)
+    except ValidationError:
+        data = extract_json(response_text)
+        report = ReportData(**data)
 
     # Append clean references
     references_md = build_references(search_results)
     report.markdown_report += "\n\n" + references_md
 
     progress(1.0, desc="✓ Report completed!")
-    return report
+    yield report.markdown_report, report
 
-async def run_research_pipeline(query: str, progress=gr.Progress()) -> tuple:
-    """Main research pipeline"""
+async def run_research_pipeline(query: str, progress=gr.Progress()):
+    """Main research pipeline; yields (summary, report, follow-ups) as the report streams in"""
     try:
         # Validate input
         if not query or len(query.strip()) < 3:
-            return "❌ Please enter a valid research query (at least 3 characters)", "", ""
+            yield "❌ Please enter a valid research query (at least 3 characters)", "", ""
+            return
         
         progress(0, desc="🚀 Starting research pipeline...")
-        
-        # Step 1: Plan searches
-        search_plan = await plan_searches(query, progress)
-        
-        # Step 2: Perform searches
-        search_results = await perform_searches(search_plan, progress)
-        
-        # Step 3: Write report
-        report = await write_report(query, search_results, progress)
+
+        # Reuse the report from a near-duplicate query if we have one
+        embedding = await asyncio.to_thread(embed_query, query)
+        report = _REPORT_CACHE.get(embedding)
+        if report is not None:
+            progress(1.0, desc="✓ Reused cached report!")
+        else:
+            # Step 1: Plan searches
+            search_plan = await plan_searches(query, progress)
+
+            # Step 2: Perform searches
+            search_results = await perform_searches(search_plan, progress)
+
+            # Step 3: Write report, streaming partial markdown to the UI
+            async for partial_markdown, report in write_report(query, search_results, progress):
+                if report is None:
+                    yield "", partial_markdown, ""
+            _REPORT_CACHE.set(embedding, report)
         # references_md = "## References\n\n"
         # counter = 1
         # for search in search_results:
@@ -249,21 +478,11 @@ async def run_research_pipeline(query: str, progress=gr.Progress()) -> tuple:
         # Format follow-up questions
         follow_up = "\n".join([f"{i}. {q}" for i, q in enumerate(report.follow_up_questions, 1)])
         
-        return report.short_summary, report.markdown_report, follow_up
+        yield report.short_summary, report.markdown_report, follow_up
         
     except Exception as e:
         error_msg = f"❌ Error: {str(e)}"
-        return error_msg, "", ""
-
-# Wrapper for Gradio
-def research_wrapper(query: str, progress=gr.Progress()):
-    """Synchronous wrapper for Gradio"""
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        return loop.run_until_complete(run_research_pipeline(query, progress))
-    finally:
-        loop.close()
+        yield error_msg, "", ""
 
 # ------------------------
 # Gradio Interface
@@ -370,7 +589,7 @@ with gr.Blocks(
     
     # Event handlers
     submit_btn.click(
-        fn=research_wrapper,
+        fn=run_research_pipeline,
         inputs=[query_input],
         outputs=[summary_output, report_output, followup_output]
     )
@@ -382,7 +601,7 @@ with gr.Blocks(
     )
     
     query_input.submit(
-        fn=research_wrapper,
+        fn=run_research_pipeline,
         inputs=[query_input],
         outputs=[summary_output, report_output, followup_output]
     )